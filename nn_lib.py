@@ -1,13 +1,37 @@
 import numpy as np
 import pickle
+
+#Floating point type of the network parameters and activations
+_DTYPE = np.float32
+
+
+def _default_rng():
+    """
+    Returns a new random generator (PCG64) seeded from numpy's global random
+    state, so that np.random.seed also makes the initialisation reproducible.
+    """
+    return np.random.default_rng(np.random.randint(2**32, dtype=np.int64))
+
+
 # GO ON
-def xavier_init(size, gain=1.0):
+def xavier_init(size, gain=1.0, out=None, rng=None):
     """
     Xavier initialization of network weights.
+
+    If `out` is given, the weights are drawn directly into it. If `rng` (a
+    np.random.Generator) is not given, one is seeded from numpy's global
+    random state.
     """
     low = -gain * np.sqrt(6.0 / np.sum(size))
     high = gain * np.sqrt(6.0 / np.sum(size))
-    return np.random.uniform(low=low, high=high, size=size)
+    if out is None:
+        out = np.empty(size, dtype=_DTYPE)
+    if rng is None:
+        rng = _default_rng()
+    rng.random(out=out, dtype=out.dtype)
+    out *= high - low
+    out += low
+    return out
 
 
 class Layer:
@@ -30,6 +54,35 @@ class Layer:
     def update_params(self, *args, **kwargs):
         pass
 
+    #Number of rows of the batches the output buffer is prepared for
+    _batch_rows = None
+    _out = None
+
+    def prepare(self, batch_size, out=None):
+        """
+        Prepares the layer to write the output of its forward pass into a
+        buffer reused across batches of `batch_size` rows (`None` releases the
+        buffer). The output of a prepared layer is only valid until its next
+        forward pass.
+
+        If `out` is given, it is used as the buffer (e.g. a slice of a larger
+        array); otherwise the buffer is allocated on first use.
+        """
+        self._batch_rows = batch_size
+        self._out = out
+
+    def _out_buffer(self, shape, dtype):
+        """
+        Returns the reused output buffer for an output of given shape and
+        dtype, or None (i.e. allocate a new array) if the layer was not
+        prepared for batches of that size.
+        """
+        if shape[0] != self._batch_rows:
+            return None
+        if self._out is None or self._out.shape != shape or self._out.dtype != dtype:
+            self._out = np.empty(shape, dtype=dtype)
+        return self._out
+
 
 class MSELossLayer(Layer):
     """
@@ -40,19 +93,21 @@ class MSELossLayer(Layer):
         self._cache_current = None
 
     @staticmethod
-    def _mse(y_pred, y_target):
-        return np.mean((y_pred - y_target) ** 2)
+    def _mse(diff):
+        #Sum of squares as a single dot product of the flattened difference
+        flat_diff = diff.reshape(-1)
+        return np.dot(flat_diff, flat_diff) / diff.size
 
     @staticmethod
-    def _mse_grad(y_pred, y_target):
-        return 2 * (y_pred - y_target) / len(y_pred)
+    def _mse_grad(diff):
+        return 2 * diff / len(diff)
 
     def forward(self, y_pred, y_target):
-        self._cache_current = y_pred, y_target
-        return self._mse(y_pred, y_target)
+        self._cache_current = y_pred - y_target
+        return self._mse(self._cache_current)
 
     def backward(self):
-        return self._mse_grad(*self._cache_current)
+        return self._mse_grad(self._cache_current)
 
 
 class CrossEntropyLossLayer(Layer):
@@ -66,23 +121,33 @@ class CrossEntropyLossLayer(Layer):
 
     @staticmethod
     def softmax(x):
-        numer = np.exp(x - x.max(axis=1, keepdims=True))
-        denom = numer.sum(axis=1, keepdims=True)
-        return numer / denom
+        #Shift, exponentiate and normalise in a single buffer
+        probs = np.subtract(x, x.max(axis=1, keepdims=True),
+                            dtype=np.result_type(x, _DTYPE))
+        np.exp(probs, out=probs)
+        probs /= probs.sum(axis=1, keepdims=True)
+        return probs
 
     def forward(self, inputs, y_target):
         assert len(inputs) == len(y_target)
         n_obs = len(y_target)
-        probs = self.softmax(inputs)
-        self._cache_current = y_target, probs
+        # Log-softmax via log-sum-exp: the loss never needs log(probs), and
+        # the gradient (probs - y_target) / n_obs is cached for backward.
+        x_max = inputs.max(axis=1, keepdims=True)
+        lse = x_max + np.log(np.exp(inputs - x_max).sum(axis=1, keepdims=True))
+        log_probs = inputs - lse
+        out = -1 / n_obs * np.sum(y_target * log_probs)
+
+        #log_probs is not needed anymore: the gradient is built in its buffer
+        grad = np.exp(log_probs, out=log_probs)
+        grad -= y_target
+        grad *= 1 / n_obs
+        self._cache_current = grad
 
-        out = -1 / n_obs * np.sum(y_target * np.log(probs))
         return out
 
     def backward(self):
-        y_target, probs = self._cache_current
-        n_obs = len(y_target)
-        return -1 / n_obs * (y_target - probs)
+        return self._cache_current
 
 
 class SigmoidLayer(Layer):
@@ -97,7 +162,12 @@ class SigmoidLayer(Layer):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-        self._cache_current = 1/(1 + np.exp(-x))
+        #1/(1 + exp(-x)) evaluated in place in a single buffer
+        dtype = np.result_type(x, _DTYPE)
+        y = np.negative(x, out=self._out_buffer(x.shape, dtype), dtype=dtype)
+        np.exp(y, out=y)
+        y += 1
+        self._cache_current = np.reciprocal(y, out=y)
 
         return self._cache_current
         #######################################################################
@@ -108,9 +178,10 @@ class SigmoidLayer(Layer):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-        #Differential of the sigmoid function
-        self.f_prime = self._cache_current * (1 - self._cache_current)
-        grad_loss_wrt_inputs = grad_z * self.f_prime
+        #Differential of the sigmoid function, y * (1 - y), times grad_z
+        grad_loss_wrt_inputs = 1 - self._cache_current
+        grad_loss_wrt_inputs *= self._cache_current
+        grad_loss_wrt_inputs *= grad_z
 
         return(grad_loss_wrt_inputs)
 
@@ -132,24 +203,24 @@ class ReluLayer(Layer):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-        self._cache_current = np.maximum(np.zeros_like(x), x)
+        #Only the sign of the input is needed for backward, so the boolean
+        #mask (1 byte per element) is cached instead of the activation
+        self._cache_current = x > 0
+        out = np.maximum(x, 0, out=self._out_buffer(x.shape, x.dtype))
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
 
-        return self._cache_current
+        return out
 
     def backward(self, grad_z):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
 
-        #Diferential of the Relu function
-        self.f_prime = self._cache_current.copy()
-        self.f_prime[self.f_prime<0] = 0
-        self.f_prime[self.f_prime>0] = 1
-
-        grad_loss_wrt_inputs = grad_z * self.f_prime
+        #Diferential of the Relu function is 1 where the input is positive
+        #and 0 elsewhere, applied as the cached mask without branching
+        grad_loss_wrt_inputs = grad_z * self._cache_current
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
@@ -175,8 +246,10 @@ class LinearLayer(Layer):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-        self._W = np.reshape(xavier_init((self.n_in * self.n_out)), (self.n_in, self.n_out))
-        self._b = np.reshape(np.random.randn((self.n_out)), (1, self.n_out))
+        rng = _default_rng()
+        self._W = np.empty((self.n_in, self.n_out), dtype=_DTYPE)
+        xavier_init(self._W.shape, out=self._W, rng=rng)
+        self._b = rng.standard_normal((1, self.n_out), dtype=_DTYPE)
 
         self._cache_current = None
         self._grad_W_current = None
@@ -202,24 +275,37 @@ class LinearLayer(Layer):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
+        #Inputs are brought to the parameters' precision (no copy if they
+        #already match) so that the products stay single precision
+        x = x.astype(self._W.dtype, copy=False)
         self.batch_size = x.shape[0]
         self._cache_current = x
         #Matrix multiplication for to go forward through the linear layer
-        return (np.matmul(x, self._W) + self._b)
+        #(bias added in place to avoid a second (batch_size, n_out) temporary)
+        z = np.matmul(x, self._W,
+                      out=self._out_buffer((x.shape[0], self.n_out), x.dtype))
+        z += self._b
+        return z
 
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
 
-    def backward(self, grad_z):
+    def backward(self, grad_z, learning_rate=None):
         """
         Given `grad_z`, the gradient of some scalar (e.g. loss) with respect to
         the output of this layer, performs back pass through the layer (i.e.
         computes gradients of loss with respect to parameters of layer and
         inputs of layer).
 
+        If `learning_rate` is given, the gradient descent step is performed
+        directly on the layer's parameters and the gradients are not stored
+        (`update_params` then has nothing left to apply).
+
         Arguments:
             grad_z {np.ndarray} -- Gradient array of shape (batch_size, n_out).
+            learning_rate {float} -- Learning rate of the fused update step
+                (default: None, gradients are stored for `update_params`).
 
         Returns:
             {np.ndarray} -- Array containing gradient with repect to layer
@@ -230,12 +316,30 @@ class LinearLayer(Layer):
         #######################################################################
 
         x = self._cache_current
-
-        self._grad_W_current = np.matmul(x.T, grad_z)
-        self._grad_b_current = np.matmul(np.ones((1, self.batch_size)), grad_z)
-
+        grad_z = grad_z.astype(self._W.dtype, copy=False)
+
+        #Bias gradient is the sum of grad_z over the batch, written into a
+        #(1, n_out) buffer allocated on first use and reused (overwritten)
+        #by every later back pass
+        if (self._grad_b_current is None
+                or self._grad_b_current.shape != (1, self.n_out)
+                or self._grad_b_current.dtype != grad_z.dtype):
+            self._grad_b_current = np.empty((1, self.n_out), dtype=grad_z.dtype)
+        np.sum(grad_z, axis=0, out=self._grad_b_current[0])
+
+        grad_W = np.matmul(x.T, grad_z)
         grad_loss_wrt_inputs = np.matmul(grad_z, self._W.T)
 
+        if learning_rate is None:
+            self._grad_W_current = grad_W
+        else:
+            #Gradient descent fused into the back pass: the weight gradient
+            #is scaled in place and subtracted without being stored
+            grad_W *= learning_rate
+            self._W -= grad_W
+            self._b -= learning_rate*self._grad_b_current
+            self._grad_W_current = None
+
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
@@ -254,6 +358,10 @@ class LinearLayer(Layer):
         #                       ** START OF YOUR CODE **
         #######################################################################
 
+        #Nothing to apply if the gradients were consumed by a fused backward
+        if self._grad_W_current is None:
+            return
+
         #Gradient descent for the weights and bias respectively
         self._W -= learning_rate*self._grad_W_current
         self._b -= learning_rate*self._grad_b_current
@@ -305,10 +413,77 @@ class MultiLayerNetwork(object):
                 continue
             else:
                 raise AssertionError("Wrong activation function")
+
+        self._resolve_layer_methods()
+        self._specialize()
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
 
+    def _resolve_layer_methods(self):
+        """
+        Resolves once the bound methods of the layers called by the passes:
+        forward in layer order, backward in reverse order (flagging linear
+        layers, whose backward also takes the learning rate) and the
+        update_params of the linear layers.
+        """
+        self._forward_chain = tuple(layer.forward for layer in self._layers)
+        self._backward_chain = tuple(
+            (layer.backward, isinstance(layer, LinearLayer))
+            for layer in reversed(self._layers))
+        self._update_chain = tuple(
+            self._layers[layer_n].update_params
+            for layer_n in self.index_linear_layer)
+
+    def _specialize(self):
+        """
+        Generates the forward, backward and update passes of this particular
+        architecture as straight-line functions calling each resolved layer
+        method in turn, so that no pass loops over the layers.
+        """
+        namespace = {}
+        forward_src = ["def _forward(x):"]
+        backward_src = ["def _backward(grad_z, learning_rate):"]
+        update_src = ["def _update_params(learning_rate):", "    pass"]
+
+        for i, forward in enumerate(self._forward_chain):
+            namespace["forward_%d" % i] = forward
+            forward_src.append("    x = forward_%d(x)" % i)
+
+        for i, (backward, is_linear) in enumerate(self._backward_chain):
+            namespace["backward_%d" % i] = backward
+            #Linear layers also take the learning rate of the fused update
+            if is_linear:
+                backward_src.append(
+                    "    grad_z = backward_%d(grad_z, learning_rate)" % i)
+            else:
+                backward_src.append("    grad_z = backward_%d(grad_z)" % i)
+
+        for i, update_params in enumerate(self._update_chain):
+            namespace["update_params_%d" % i] = update_params
+            update_src.append("    update_params_%d(learning_rate)" % i)
+
+        forward_src.append("    return x")
+        backward_src.append("    return grad_z")
+        source = "\n".join(forward_src + backward_src + update_src) + "\n"
+        exec(compile(source, "<MultiLayerNetwork>", "exec"), namespace)
+
+        self._forward = namespace["_forward"]
+        self._backward = namespace["_backward"]
+        self._update_params = namespace["_update_params"]
+
+    def __getstate__(self):
+        #Generated functions cannot be pickled: they are rebuilt on loading
+        state = self.__dict__.copy()
+        for name in ("_forward", "_backward", "_update_params"):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._resolve_layer_methods()
+        self._specialize()
+
 
     def forward(self, x):
         """
@@ -326,9 +501,7 @@ class MultiLayerNetwork(object):
         #######################################################################
 
         #Forwards through all the layers
-        for i in range(len(self._layers)):
-            x = self._layers[i].forward(x)
-        return x
+        return self._forward(x)
 
         #######################################################################
         #                       ** END OF YOUR CODE **
@@ -340,13 +513,51 @@ class MultiLayerNetwork(object):
         """
         return self.forward(x)
 
-    def backward(self, grad_z):
+    def prepare(self, batch_size):
+        """
+        Prepares all the layers to reuse their output buffers across batches
+        of `batch_size` rows (see `Layer.prepare`), or releases the buffers if
+        `batch_size` is None.
+
+        The buffers of all the layers are consecutive slices of a single
+        array, so the activations of a batch sit in one contiguous block.
+
+        Arguments:
+            batch_size {int} -- Number of rows of the batches to come.
+        """
+        if batch_size is None:
+            for layer in self._layers:
+                layer.prepare(None)
+            return
+
+        #Output width of every layer (activations keep their input width)
+        widths = []
+        width = self.input_dim
+        for layer in self._layers:
+            if isinstance(layer, LinearLayer):
+                width = layer.n_out
+            widths.append(width)
+
+        activations = np.empty(batch_size * sum(widths), dtype=_DTYPE)
+        start = 0
+        for layer, width in zip(self._layers, widths):
+            stop = start + batch_size * width
+            layer.prepare(batch_size,
+                          out=activations[start:stop].reshape(batch_size, width))
+            start = stop
+
+    def backward(self, grad_z, learning_rate=None):
         """
         Performs backward pass through the network.
 
+        If `learning_rate` is given, each linear layer also performs its
+        gradient descent step during the pass (see `LinearLayer.backward`).
+
         Arguments:
             grad_z {np.ndarray} -- Gradient array of shape (1,
                 #_neurons_in_final_layer).
+            learning_rate {float} -- Learning rate of the fused update step
+                (default: None, no update is performed).
 
         Returns:
             {np.ndarray} -- Array containing gradient with repect to layer
@@ -358,9 +569,7 @@ class MultiLayerNetwork(object):
         #######################################################################
 
         #Backpropagation through all the layers
-        for layer_n in range(len(self._layers)-1,-1,-1):
-            grad_z = self._layers[layer_n].backward(grad_z)
-        return grad_z #RETURNS GRADIENT OF FUNC WRT TO INPUTS
+        return self._backward(grad_z, learning_rate) #RETURNS GRADIENT OF FUNC WRT TO INPUTS
 
         #######################################################################
         #                       ** END OF YOUR CODE **
@@ -380,11 +589,7 @@ class MultiLayerNetwork(object):
         #######################################################################
 
         #Parameters update performed on the linear layers only
-        for layer_n in range(len(self._layers)-1,-1,-1):
-            if layer_n in self.index_linear_layer:
-                self._layers[layer_n].update_params(learning_rate)
-            else:
-                continue
+        self._update_params(learning_rate)
 
         #######################################################################
         #                       ** END OF YOUR CODE **
@@ -408,6 +613,13 @@ def load_network(fpath):
     return network
 
 
+#Loss layer class for each loss function name accepted by the Trainer
+_LOSS_LAYERS = {
+    "mse": MSELossLayer,
+    "cross_entropy": CrossEntropyLossLayer,
+}
+
+
 class Trainer(object):
     """
     Trainer: Object that manages the training of a neural network.
@@ -430,7 +642,7 @@ class Trainer(object):
             nb_epoch {int} -- Number of training epochs.
             learning_rate {float} -- SGD learning rate to be used in training.
             loss_fun {str} -- Loss function to be used. Possible values: mse,
-                bce.
+                cross_entropy.
             shuffle_flag {bool} -- If True, training data is shuffled before
                 training.
         """
@@ -445,12 +657,9 @@ class Trainer(object):
         #                       ** START OF YOUR CODE **
         #######################################################################
 
-        if self.loss_fun is 'mse':
-            self._loss_layer = MSELossLayer()
-        elif self.loss_fun is 'cross_entropy':
-            self._loss_layer = CrossEntropyLossLayer()
-        else:
+        if self.loss_fun not in _LOSS_LAYERS:
             raise Exception('Wrong Loss, chose between: mse, cross_entropy')
+        self._loss_layer = _LOSS_LAYERS[self.loss_fun]()
 
         #######################################################################
         #                       ** END OF YOUR CODE **
@@ -473,15 +682,12 @@ class Trainer(object):
         #                       ** START OF YOUR CODE **
         #######################################################################
 
-        #Reshaping to use the create indices and shuffle the array
-        if target_dataset.shape == (input_dataset.shape[0],):
-            target_dataset = target_dataset.reshape(input_dataset.shape[0], 1)
-
-        #Creating of shuffled indices to shuffle the full dataset
+        #Creating of shuffled indices to shuffle the full dataset (indexing
+        #along the first axis works for 1D and 2D targets alike)
         indices = np.random.permutation(input_dataset.shape[0])
 
-        shuffled_inputs = input_dataset[indices,:]
-        shuffled_targets = target_dataset[indices,:]
+        shuffled_inputs = input_dataset[indices]
+        shuffled_targets = target_dataset[indices]
 
         #Reshaping to comply with teh LabTS tests
         if shuffled_targets.shape == (input_dataset.shape[0], 1):
@@ -516,36 +722,49 @@ class Trainer(object):
         #                       ** START OF YOUR CODE **
         #######################################################################
 
-        #Finding the number of batches based on the batch size
-        n_batches = np.floor(input_dataset.shape[0]/self.batch_size).astype(int)
-
-        for epoch in range(self.nb_epoch):
-
-            #Reshaping in case of single input
-            if input_dataset.shape == (input_dataset.shape[0],):
-                input_dataset = input_dataset.reshape(input_dataset.shape[0], 1)
-
-            if self.shuffle_flag:
-                input_dataset,target_dataset = self.shuffle(input_dataset,target_dataset)
-
-            #Reshaping to use hstack
-            if target_dataset.shape == (input_dataset.shape[0],):
-                target_dataset = target_dataset.reshape(input_dataset.shape[0], 1)
-
-            #Splitting into the n batches
-            data = np.hstack((input_dataset,target_dataset))
-            batch_list = np.vsplit(data[:int(n_batches*self.batch_size)],n_batches)
-            #Adding the remainder datapoints to the last batch
-            if int(n_batches*self.batch_size) != data.shape[0]:
-                batch_list.append(data[int(n_batches*self.batch_size):])
-
-            #Performing backpropagation and paramters update
-            for batch in batch_list:
-                loss = self.eval_loss(batch[:,:-target_dataset.shape[1]],batch[:,-target_dataset.shape[1]:])
-                #loss_arr.append(loss) ##TO BE TAKEN OFF ONCE NOT TESTING ANYMORE
-
-                self.multilayer_network.backward(self.grad_z)
-                self.multilayer_network.update_params(self.learning_rate)
+        n_data = input_dataset.shape[0]
+
+        #Reshaping in case of single input or single target
+        if input_dataset.shape == (n_data,):
+            input_dataset = input_dataset.reshape(n_data, 1)
+        if target_dataset.shape == (n_data,):
+            target_dataset = target_dataset.reshape(n_data, 1)
+
+        #Converting the inputs once to a contiguous array of the network's
+        #precision, so that no batch is copied again before its products
+        input_dataset = np.ascontiguousarray(input_dataset, dtype=_DTYPE)
+
+        #Methods and settings used for every batch, looked up only once
+        eval_loss = self.eval_loss
+        backward = self.multilayer_network.backward
+        batch_size = self.batch_size
+        learning_rate = self.learning_rate
+
+        #Layers write full batches into reused buffers during training only,
+        #so that outputs returned to the caller afterwards are never shared
+        self.multilayer_network.prepare(batch_size)
+        try:
+            for epoch in range(self.nb_epoch):
+
+                #Shuffling through a permutation index (targets stay 2D, as
+                #opposed to the output of Trainer.shuffle)
+                if self.shuffle_flag:
+                    indices = np.random.permutation(n_data)
+                    inputs = input_dataset[indices]
+                    targets = target_dataset[indices]
+                else:
+                    inputs, targets = input_dataset, target_dataset
+
+                #Batches are slices (views) of the epoch's arrays, the
+                #remainder datapoints forming a last smaller batch
+                for start in range(0, n_data, batch_size):
+                    stop = start + batch_size
+                    loss = eval_loss(inputs[start:stop], targets[start:stop])
+
+                    #Performing backpropagation and paramters update in one pass
+                    backward(self.grad_z, learning_rate)
+        finally:
+            self.multilayer_network.prepare(None)
 
         return
 
@@ -601,6 +820,12 @@ class Preprocessor(object):
         #Axis 0 which corresponds to taking the max for each feature
         self.max_data = np.max(data, axis = 0)
         self.min_data = np.min(data, axis = 0)
+        #Range and its inverse, computed once so that apply multiplies
+        #instead of dividing (constant features get an infinite inverse, as
+        #dividing by their zero range did)
+        self._range = self.max_data - self.min_data
+        with np.errstate(divide="ignore"):
+            self._inv_range = 1 / self._range
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################
@@ -618,8 +843,12 @@ class Preprocessor(object):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-
-        return (data - self.min_data)/(self.max_data - self.min_data)
+        #(data - min) * 1/range, computed in a single buffer at the
+        #precision of the data
+        out = np.subtract(data, self.min_data,
+                          dtype=np.result_type(data, self._inv_range))
+        out *= self._inv_range
+        return out
 
         #######################################################################
         #                       ** END OF YOUR CODE **
@@ -638,7 +867,9 @@ class Preprocessor(object):
         #######################################################################
         #                       ** START OF YOUR CODE **
         #######################################################################
-        return self.min_data + normalised_data*(self.max_data - self.min_data)
+        out = np.multiply(normalised_data, self._range)
+        out += self.min_data
+        return out
         #######################################################################
         #                       ** END OF YOUR CODE **
         #######################################################################